@@ -27,10 +27,12 @@ class KslNotifyCli(KslCli):
         self.parser.add_argument('-X', '--exclude-links', default=False, action='store_true',
                                  help='Exclude links from message.')
         self.parser.add_argument('-L', '--load', default=None,
-                                 help='Load seen listings from a JSON file. ' 
-                                      'Format is a dictionary of query search terms to listing links.')
+                                 help='Load seen listings from a file. '
+                                      'Format is a pickled dictionary of query search terms to '
+                                      'hashed listing links (not hand-editable; legacy JSON files '
+                                      'with full links still load).')
         self.parser.add_argument('-S', '--save', default=None,
-                                 help='Save seen listings to a JSON file.')
+                                 help='Save seen listings to a file.')
         self.parser.add_argument('-l', '--logfile', default=None,
                                  help='File to log output from daemon process, defaults to stdout')
         self.parser.add_argument('--loglevel', default="INFO",
@@ -1,18 +1,50 @@
+import asyncio
 import concurrent.futures
+import functools
+import operator
 
-from collections import namedtuple
-from urllib.request import Request, build_opener, HTTPCookieProcessor
-from urllib.parse import urlencode, urljoin
-from http.cookiejar import CookieJar
+from dataclasses import dataclass
+from urllib.parse import urlencode, urljoin, quote_plus
 import logging
 
-from bs4 import BeautifulSoup
-import json
+import aiohttp
+from lxml import html as lxml_html
+import re
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    # orjson is optional; the stdlib parser works, just slower
+    from json import loads as json_loads
 from datetime import datetime, timedelta
 
 from cli.ksl_cli import KslCli
 
-Listing = namedtuple('Listing', 'title city state age price link description')
+@dataclass(frozen=True, slots=True)
+class Listing:
+    title: str
+    city: str
+    state: str
+    age: str
+    price: int
+    link: str
+    description: str
+
+# Fast path for find_elements: the listings JSON array sits on a single
+# line inside the window.renderSearchSection({...}) script, so it can be
+# sliced straight out of the raw bytes without building an HTML tree.
+LISTINGS_RE = re.compile(rb'renderSearchSection\(\s*\{\s*listings:\s*(\[[^\n]*\])')
+
+# Grab every always-present Listing field from an ad dict in one C-level
+# call; price is fetched separately since free items omit it
+AD_FIELDS = operator.itemgetter('title', 'city', 'state', 'displayTime',
+                                'id', 'description')
+
+
+@functools.lru_cache(maxsize=256)
+def _build_url(query, static_qs):
+    # The daemon regenerates identical URLs every poll cycle; memoize them
+    return ''.join((KSL.SEARCH_URL, 'keyword=',
+                    quote_plus(str(query)), '&', static_qs))
 
 
 class KSL(object):
@@ -44,52 +76,134 @@ class KSL(object):
     }
 
     def __init__(self):
-        self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
-
-    @staticmethod
-    def __do_request(args):
-        logging.debug("Performing request for args {args}".format(args=args))
-        if len(args) == 2:
-            query, url = args
-            timeout = 5  # seconds
-        else:
-            query, url, timeout = args
-        req = Request(
-            url,
-            data=None,
-            headers={
-                'User-Agent': ('Mozilla/5.0')
-            }
-        )
-        cookies = CookieJar()
-        opener = build_opener(HTTPCookieProcessor(cookies))
-        response = opener.open(req, timeout=timeout)
-
-        return query, response.read()
+        self.connector_limit = 16
+        # validators for conditional GETs, keyed by url; a 304 means the
+        # page is unchanged and there is nothing to parse this poll
+        self._etags = {}
+        self._modified = {}
+        # one event loop and client session per instance, created lazily,
+        # so keep-alive connections survive across search() calls instead
+        # of paying TCP+TLS setup every daemon poll cycle
+        self._loop = None
+        self._session = None
+
+    async def __do_request(self, session, query, url, timeout=5):
+        logging.debug("Performing request for url %s", url)
+        headers = {}
+        if url in self._etags:
+            headers['If-None-Match'] = self._etags[url]
+        if url in self._modified:
+            headers['If-Modified-Since'] = self._modified[url]
+        async with session.get(
+                url, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status == 304:
+                logging.debug("Not modified since last poll: %s", url)
+                return query, None
+            etag = response.headers.get('ETag')
+            if etag:
+                self._etags[url] = etag
+            modified = response.headers.get('Last-Modified')
+            if modified:
+                self._modified[url] = modified
+            # The listings JSON sits near the top of the page; once its
+            # line is fully buffered the rest of the body is dead weight,
+            # so stop reading early. Pages without the marker are read in
+            # full and handled by the fallback parser.
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(16384):
+                body += chunk
+                start = body.find(b'listings:')
+                if start != -1 and body.find(b'\n', start) != -1:
+                    break
+            return query, bytes(body)
+
+    async def __search_all(self, queries, **etc):
+        # multiplex every query over one connection pool on a single thread
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connector_limit),
+                headers={'User-Agent': 'Mozilla/5.0',
+                         # compressed transfer; aiohttp inflates for us
+                         'Accept-Encoding': 'gzip, deflate'})
+        requests = [self.__do_request(self._session, query, url)
+                    for query, url in self.build_qs(queries, **etc)]
+        return await asyncio.gather(*requests)
 
     def search(self, query, **etc):
-        with self.thread_pool as ex:
-            # perform every search using the thread pool executor
-            logging.debug("Beginning search using thread pool for query {query}.".format(query=query))
-            yield from ex.map(self.__do_request, self.build_qs(query, **etc))
+        logging.debug("Beginning async search for query %s.", query)
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        yield from self._loop.run_until_complete(
+            self.__search_all(query, **etc))
+
+    def close(self):
+        # release the client session and event loop
+        if self._session is not None and not self._session.closed:
+            self._loop.run_until_complete(self._session.close())
+        self._session = None
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
 
     # NOTE: raw_html function is broken now that listings are JavaScript...
     def find_elements(self, html, raw_html=False):
+        if html is None:
+            # 304 Not Modified: nothing new since the last poll
+            return []
+        # Fast path: slice the listings JSON out of the raw bytes without
+        # parsing any HTML at all.
+        match = LISTINGS_RE.search(html)
+        if match:
+            listings_elements = json_loads(match.group(1))
+            logging.debug("Extracted listings JSON with regex fast path.")
+        else:
+            # Fall back to walking the script tags in case the page layout
+            # shifted enough to dodge the regex.
+            listings_elements = self.__find_listings_json(html)
+
+        # keys in each listing:
+        #  'createTime', 'cellPhone', 'lat', 'modifyTime', 'sellerType',
+        #  'marketType', 'favorited', 'state', 'city', 'source', 'lon',
+        #  'description', 'pageviews', 'memberId', 'city_lower', 'subCategory',
+        #  'photo', 'email', 'category', 'displayTime', 'price', 'zip',
+        #  'homePhone', 'listingType', 'expireTime', 'title', 'id', 'name'
+        logging.debug("Converting listing dictionary into Listing objects.")
+        listings = []
+        offset = self.time_offset
+        ad_boxes = (ad_box for ad_box in listings_elements
+                    if 'featured' not in ad_box['listingType'])
+        for ad_box in ad_boxes:
+            (title, city, state, display_time,
+             ad_id, description) = AD_FIELDS(ad_box)
+            # Free items are missing the price
+            price = ad_box.get('price', 0)
+            # displayTime is always "%Y-%m-%dT%H:%M:%SZ"; fromisoformat is
+            # C-implemented and far cheaper than strptime per listing
+            created = (datetime.fromisoformat(display_time[:-1])
+                       + offset)
+            lifespan = str(created)
+            link = urljoin(self.LIST_URL, str(ad_id))
+            listings.append(Listing(title, city, state, lifespan, price,
+                                    link, description))
+        return listings
+
+    def __find_listings_json(self, html):
         logging.debug("Parsing HTML...")
-        soup = BeautifulSoup(html, 'html.parser')
+        root = lxml_html.fromstring(html)
 
         # Webpage uses a javascript data structure to hold ad info
-        listings_elements = []
-        for script in soup.find_all('script'):
-            if "listings: " in str(script):
+        for script in root.iter('script'):
+            text = script.text or ''
+            if "listings: " in text:
                 # reduce script to just json structure
                 # Looks something like this right now:
                 #  window.renderSearchSection({ listings: [{"id" . . .
                 #  ...
                 #  })
                 # So we just need to grab stuff between outer parens
-                list_json = (script.contents[0].split('(', 1)[-1]
-                                               .rsplit(')', 1)[0])
+                list_json = (text.split('(', 1)[-1]
+                                 .rsplit(')', 1)[0])
                 # Put double quotes around property name
                 list_json = list_json.replace('listings: ', '"listings": ')
                 # Remove unneeded and poorly formatted properties
@@ -101,93 +215,85 @@ class KSL(object):
                 list_json = "\n".join(list_json.split("\n")[:2])
                 list_json = list_json.rstrip(',') + "}"
                 # Turn the json into a dict and grab the list of listings
-                listings_elements = json.loads(list_json)['listings']
                 logging.debug("Converted JSON listings into dictionary.")
-                break
-
-        # keys in each listing:
-        #  'createTime', 'cellPhone', 'lat', 'modifyTime', 'sellerType',
-        #  'marketType', 'favorited', 'state', 'city', 'source', 'lon',
-        #  'description', 'pageviews', 'memberId', 'city_lower', 'subCategory',
-        #  'photo', 'email', 'category', 'displayTime', 'price', 'zip',
-        #  'homePhone', 'listingType', 'expireTime', 'title', 'id', 'name'
-        logging.debug("Converting listing dictionary into Listing objects.")
-        listings = []
-        for ad_box in listings_elements:
-            if 'featured' in ad_box['listingType']:
-                continue
-            if 'price' not in ad_box:
-                # Free items are missing the price
-                ad_box['price'] = 0
-            created = (datetime.strptime(ad_box['displayTime'],
-                                         "%Y-%m-%dT%H:%M:%SZ")
-                       + self.time_offset)
-            lifespan = str(created)
-            link = urljoin(self.LIST_URL, str(ad_box['id']))
-            listings.append(Listing(ad_box['title'], ad_box['city'], ad_box['state'],
-                          lifespan, ad_box['price'], link,
-                          ad_box['description']))
-        return listings
+                return json_loads(list_json)['listings']
+        return []
 
     def build_qs(self, queries, **etc):
         logging.debug("Building query...")
+        # everything except the keyword is invariant across queries (and
+        # across daemon poll cycles), so encode it once up front
+        static_qs = self.__compile_static_qs(etc)
         for query in queries:
-            args = etc.copy()
-            # ensure we always have a minimum price, of at least $0
-            minp = max(0, int(args.pop('min_price', '0')))
-
-            maxp = max(0, int(args.pop('max_price', '0')))
-            # if we have a minimum and maximum price
-            # then we want to make sure the lower value is set to `minp`
-            if minp and maxp:
-                minp, maxp = sorted([minp, maxp])
-            minp = None if minp == 0 else minp
-            maxp = None if maxp == 0 else maxp
-
-            # If city, assure state exists
-            if (('city' in args and args['city'])
-                    and ('state' not in args or not args['state'])):
-                args['state'] = 'UT'
-
-            qs = {
-                'keyword': query,
-                'priceFrom': minp,
-                'priceTo': maxp
-            }
-
-            # apply defaults
-            qs.update(self.URL_QS)
-
-            # fill in any additional parameters
-            # that were passed, but not explicitly handled
-            for k, value in args.items():
-                if k in KSL.QUERY_PARAM_KEYS:
-                    qs.setdefault(k, value)
-
-            # Remove None values
-            qs = {k: v for k, v in qs.items() if v is not None}
-
-            logging.debug("Using the following query params: {query}".format(query=qs))
-
-            # encode
-            qs = urlencode(qs)
-            queryurl = self.SEARCH_URL + qs
-            logging.debug("Generated the search URL: {url}".format(url=queryurl))
+            queryurl = _build_url(query, static_qs)
+            logging.debug("Generated the search URL: %s", queryurl)
             yield (query, queryurl, )
 
+    @staticmethod
+    def __compile_static_qs(etc):
+        args = etc.copy()
+        # keyword is supplied per query by build_qs
+        args.pop('keyword', None)
+        # ensure we always have a minimum price, of at least $0
+        minp = max(0, int(args.pop('min_price', '0')))
+
+        maxp = max(0, int(args.pop('max_price', '0')))
+        # if we have a minimum and maximum price
+        # then we want to make sure the lower value is set to `minp`
+        if minp and maxp:
+            minp, maxp = sorted([minp, maxp])
+        minp = None if minp == 0 else minp
+        maxp = None if maxp == 0 else maxp
+
+        # If city, assure state exists
+        if (('city' in args and args['city'])
+                and ('state' not in args or not args['state'])):
+            args['state'] = 'UT'
+
+        qs = {
+            'priceFrom': minp,
+            'priceTo': maxp
+        }
+
+        # apply defaults
+        qs.update(KSL.URL_QS)
+
+        # fill in any additional parameters
+        # that were passed, but not explicitly handled
+        for k, value in args.items():
+            if k in KSL.QUERY_PARAM_KEYS:
+                qs.setdefault(k, value)
+
+        # Remove None values
+        qs = {k: v for k, v in qs.items() if v is not None}
+
+        logging.debug("Using the following query params: %s", qs)
+
+        # encode
+        return urlencode(qs)
+
     def listing(self, id):
         pass
 
 
+@functools.lru_cache(maxsize=10000)
+def _format_listing(result):
+    # listings never change once posted, so the formatted block can be
+    # cached for repeat appearances across searches
+    return (f'{result.title} - ${result.price} - {result.age} : '
+            f'{result.city}, {result.state}\n'
+            f'   {result.link}\n'
+            f'   {result.description}\n\n')
+
+
 def gather_report(query_result):
-    logging.debug("Gathering report for {count} listings".format(count=len(query_result)))
-    report = ""
-    for result in query_result:
-        report += ('{result.title} - ${result.price} - {result.age} : '
-                   '{result.city}, {result.state}\n'
-                   '   {result.link}\n'
-                   '   {result.description}\n\n'.format(**locals()))
-    return report
+    logging.debug("Gathering report for %d listings", len(query_result))
+    return ''.join(map(_format_listing, query_result))
+
+
+def _parse_response(html_data):
+    # module-level so ProcessPoolExecutor can pickle it
+    return KSL().find_elements(html_data)
 
 
 def main(args):
@@ -199,13 +305,21 @@ def main(args):
 
     # find our results
     queries = args.pop('query')
-    for query, html_data in ksl.search(queries, **args):
-        query_result = ksl.find_elements(html_data)
-        report = gather_report(query_result)
-        if report:
-            if len(queries) > 1:
-                print("** Search for %s **" % query)
-            print(report)
+    try:
+        results = list(ksl.search(queries, **args))
+    finally:
+        ksl.close()
+    # fan the CPU-bound parsing out across cores; the GIL blocks thread
+    # parallelism for this part
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        parsed = executor.map(_parse_response,
+                              (html_data for _, html_data in results))
+        for (query, _), query_result in zip(results, parsed):
+            report = gather_report(query_result)
+            if report:
+                if len(queries) > 1:
+                    print("** Search for %s **" % query)
+                print(report)
 
 
 if __name__ == '__main__':
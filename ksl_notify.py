@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
+import functools
+import hashlib
 import os
+import queue
+import re
+import signal
 import sys
 import logging
+import threading
 import time
 import datetime
 import getpass
 import socket
 
-from util.email import EmailSession
+from email.message import EmailMessage
+
 from util import io
-from ksl import KSL
 from cli.ksl_notify_cli import KslNotifyCli
 
 # Message strings
@@ -20,27 +26,141 @@ BODY_TEMPLATE = "\r\n".join([
     "{header}",
     "",
     "{listings_report}"])
-MESSAGE_TEMPLATE = "\r\n".join([
-    "Subject: {subject}",
-    "To: {receiver}",
-    "From: {sender}",
-    "",
-    "{body}"])
+# Matches the non-ascii characters stripped from outgoing messages
+NON_ASCII_RE = re.compile(r'[^\x00-\x7f]')
 
+# Separator line between listings in a report
+BANNER = '*' * 25
 
-def check_ksl(args, queries, seen, receiver, sender, passwd, smtpserver):
-    # create the thin object
-    ksl = KSL()
+
+def _link_hash(link):
+    # seen stores 8-byte digests instead of full URLs: an order of
+    # magnitude less memory and snapshot size, with collision odds far
+    # below anything that matters at tens of thousands of listings
+    return hashlib.blake2b(link.encode(), digest_size=8).digest()
+
+# Set by signal handlers: _wake interrupts the sleep between polls
+# (SIGUSR1 forces an immediate poll), _shutdown asks the main loop to
+# save and exit instead of sleeping out the rest of loop_delay
+_wake = threading.Event()
+_shutdown = threading.Event()
+
+
+def _handle_wake(signum, frame):
+    _wake.set()
+
+
+def _handle_shutdown(signum, frame):
+    _shutdown.set()
+    _wake.set()
+
+def build_message(subject, sender, receiver, body):
+    # One EmailMessage per chunk; smtplib.send_message derives the
+    # envelope from the headers and pipelines the SMTP commands where the
+    # server advertises it, unlike raw sendmail strings
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['To'] = receiver
+    message['From'] = sender
+    message.set_content(body)
+    return message
+
+
+# Messages still failing after this many attempts are dropped and
+# counted against the main loop's exception ladder
+MAX_SEND_ATTEMPTS = 3
+# Seconds before retrying a failed message, scaled by attempt number, so
+# the attempts span several poll cycles instead of a few milliseconds
+SEND_RETRY_DELAY = 300
+
+_send_failures = 0
+_send_failures_lock = threading.Lock()
+
+
+def _record_send_failure():
+    global _send_failures
+    with _send_failures_lock:
+        _send_failures += 1
+
+
+def _drain_send_failures():
+    global _send_failures
+    with _send_failures_lock:
+        count, _send_failures = _send_failures, 0
+    return count
+
+
+def email_worker(email_session, outbox):
+    """Drain queued EmailMessage objects over the shared SMTP session so
+    the polling loop never blocks on mail round-trips. A failed send is
+    requeued with a retry-after time, up to MAX_SEND_ATTEMPTS spread
+    over several poll cycles; messages dropped after that are counted so
+    the main loop's exception ladder still sees a persistent SMTP
+    outage."""
+    while True:
+        item = outbox.get()
+        if item is None:
+            break
+        # requeued items carry their attempt count and earliest retry
+        message, attempts, not_before = (item if isinstance(item, tuple)
+                                         else (item, 0, 0.0))
+        try:
+            wait = not_before - time.time()
+            if wait > 0:
+                # _shutdown aborts the pause so the final drain at exit
+                # makes its attempt immediately instead of stalling
+                _shutdown.wait(wait)
+            # the connection likely idled through several poll cycles
+            email_session.ensure_alive()
+            email_session.send_message(message)
+        except Exception:
+            attempts += 1
+            if attempts < MAX_SEND_ATTEMPTS:
+                logging.exception("Failed to send queued email, "
+                                  "retrying in %d seconds (attempt %d)",
+                                  SEND_RETRY_DELAY * attempts, attempts)
+                outbox.put((message, attempts,
+                            time.time() + SEND_RETRY_DELAY * attempts))
+            else:
+                logging.exception("Dropping email after %d failed "
+                                  "send attempts", attempts)
+                _record_send_failure()
+        finally:
+            outbox.task_done()
+
+
+def check_ksl(ksl, args, queries, seen, receiver, sender, outbox, new_links):
+    """new_links is an out-parameter: links first seen this poll are
+    recorded in it per query as they are queued, so the caller's finally
+    block can journal whatever actually happened even if a later query
+    in the same poll raises."""
     logging.debug("Beginning search...")
+    # links reported earlier in this same poll: a listing matching two
+    # queries should only produce one email
+    round_seen = set()
+    # the From header is the same for every message this poll
+    from_header = SENDER_TEMPLATE.format(sender=sender)
     for query, html_data in ksl.search(queries, **args):
         if query not in seen:
-            seen[query] = []
-            logging.debug("Initialized query {query} into seen dictionary.".format(query=query))
+            seen[query] = set()
+            logging.debug("Initialized query %s into seen dictionary.", query)
 
         logging.debug("Filtering out seen listings...")
-        query_result = [listing for listing in ksl.find_elements(html_data) if listing.link not in seen[query]]
-        logging.debug("Acquired {count} unseen listings: {listings}".format(count=len(query_result),
-                                                                            listings=query_result))
+        query_result = []
+        for listing in ksl.find_elements(html_data):
+            link_hash = _link_hash(listing.link)
+            if link_hash in seen[query]:
+                continue
+            if link_hash in round_seen:
+                # already reported under an earlier query this poll;
+                # record it for this query too so it stays suppressed on
+                # future polls instead of resurfacing as a duplicate
+                seen[query].add(link_hash)
+                new_links.setdefault(query, []).append(link_hash)
+                continue
+            query_result.append(listing)
+        logging.debug("Acquired %d unseen listings: %r",
+                      len(query_result), query_result)
 
         logging.debug("Creating message bodies for listings...")
         links_by_message_body = create_message_bodies(query,
@@ -49,94 +169,153 @@ def check_ksl(args, queries, seen, receiver, sender, passwd, smtpserver):
                                                       args['head'],
                                                       args['exclude_links'])
 
-        # Email new results
-        with EmailSession(sender, passwd, smtpserver) as email_session:
-            for i, (message_body, links) in enumerate(links_by_message_body.items()):
-                # Format templates
-                subject = SUBJECT_TEMPLATE.format(query=query,
-                                                  total=len(links_by_message_body),
-                                                  n=i + 1,
-                                                  time=get_time())
-
-                message = MESSAGE_TEMPLATE.format(subject=subject,
-                                                  sender=SENDER_TEMPLATE.format(sender=sender),
-                                                  receiver=receiver,
-                                                  body=message_body)
-
-                logging.info("Sending email {n} of {total}".format(n=i + 1, total=len(links_by_message_body)))
-                email_session.sendmail(sender.format(mail=sender), receiver, message)
-                # Store results for next time
-                seen[query].extend(links)
-                logging.debug("Sent this message:\n{message}".format(message=message))
-
-            if len(links_by_message_body) == 0:
-                logging.info("No new search results found. No email sent.")
-
-        logging.debug("{count} emails sent to {receiver}."
-                      .format(count=len(links_by_message_body.keys()), receiver=receiver))
+        # Queue new results for the email worker and move straight on to
+        # the next query's parse
+        total = len(links_by_message_body)
+        for i, (message_body, links) in enumerate(links_by_message_body.items()):
+            # Format templates
+            subject = SUBJECT_TEMPLATE.format(query=query,
+                                              total=total,
+                                              n=i + 1,
+                                              time=get_time())
+
+            message = build_message(subject, from_header, receiver,
+                                    message_body)
+
+            logging.info("Queueing email %d of %d", i + 1, total)
+            outbox.put(message)
+            # Store results for next time
+            link_hashes = [_link_hash(link) for link in links]
+            seen[query].update(link_hashes)
+            round_seen.update(link_hashes)
+            new_links.setdefault(query, []).extend(link_hashes)
+            logging.debug("Queued this message:\n%s", message)
+
+        if len(links_by_message_body) == 0:
+            logging.info("No new search results found. No email sent.")
+
+        logging.debug("%d emails queued for %s.",
+                      len(links_by_message_body), receiver)
     return seen
 
 
+@functools.lru_cache(maxsize=4096)
 def get_report(listing, head=None, exclude_links=False):
+    # Listing is a frozen dataclass, so a listing that shows up under
+    # several overlapping queries formats (and ascii-strips) only once
     description = listing.description
 
     # Only report the first n lines of the description if head is specified
     if head:
-        description = '\n'.join(listing.description.strip().split('\n')[:head])
+        # maxsplit caps the work at the lines we actually keep
+        description = '\n'.join(description.strip().split('\n', head)[:head])
 
-    link_formatted = '{link}\n'.format(link=listing.link) if not exclude_links else ''
+    link_formatted = listing.link + '\n' if not exclude_links else ''
 
-    listing_formatted = ('*' * 25 + '\n'
-                                    '{link_formatted}'
-                                    '{listing.title}\n'
-                                    '${listing.price} - {listing.age} - '
-                                    '{listing.city}, {listing.state}\n'
-                                    '*  {description}\n\n'.format(**locals()))
+    # f-string rather than str.format: this runs once per listing and the
+    # FORMAT_VALUE bytecode path skips the format-spec parsing overhead
+    listing_formatted = (f'{BANNER}\n'
+                         f'{link_formatted}'
+                         f'{listing.title}\n'
+                         f'${listing.price} - {listing.age} - '
+                         f'{listing.city}, {listing.state}\n'
+                         f'*  {description}\n\n')
 
-    # Kill non-ascii characters
-    return listing_formatted.encode('ascii', 'ignore').decode()
+    # Kill non-ascii characters in one pass, without the bytes round-trip
+    # that encode('ascii', 'ignore').decode() would allocate
+    return NON_ASCII_RE.sub('', listing_formatted)
 
 
 def create_message_bodies(search_term, listings, char_limit=None, head=None, exclude_links=False):
-    report_by_listing = {}
-    # Format listings
-    for listing in listings:
-        report_by_listing[listing] = get_report(listing, head, exclude_links)
+    if not listings:
+        return {}
 
     header = HEADER_TEMPLATE.format(plural="es" if len(listings) > 1 else "", query=search_term)
+
+    if not char_limit:
+        # No limit means exactly one message per query: join the reports
+        # in a single pass with none of the budget bookkeeping below
+        report = ''.join(get_report(listing, head, exclude_links)
+                         for listing in listings)
+        return {BODY_TEMPLATE.format(header=header, listings_report=report):
+                [listing.link for listing in listings]}
+
+    # the subject is only needed here for its length; the real one is
+    # formatted per message in check_ksl. Measure against a fixed-width
+    # stand-in time (%H:%M is always 5 chars) instead of calling get_time
     subject = SUBJECT_TEMPLATE.format(query=search_term,
                                       n=len(listings),
                                       total=len(listings),
-                                      time=get_time())
+                                      time='00:00')
 
     links_by_message_body = {}
     links = []
-    listings_report = ""
-
-    # If there's a character limit, break the report into parts so that no part exceeds char_limit.
-    for listing, report in report_by_listing.items():
-        if char_limit:
-            # If listing pushes message body past character count, store message body without adding the listing.
-            # Note: Subject is included in char count since it's included in the message body when sent as SMS.
-            if len(listings_report) + len(report) + len(header) + len(subject) > char_limit:
-                links_by_message_body[BODY_TEMPLATE.format(header=header, listings_report=listings_report)] = links
-                listings_report = ""
-                links = []
+    parts = []
+    parts_len = 0
+    # Note: Subject is included in char count since it's included in the message body when sent as SMS.
+    overhead = len(header) + len(subject)
+
+    # Break the report into parts so that no part exceeds char_limit.
+    for listing in listings:
+        report = get_report(listing, head, exclude_links)
+        # If listing pushes message body past character count, store message body without adding the listing.
+        if parts_len + len(report) + overhead > char_limit:
+            links_by_message_body[BODY_TEMPLATE.format(header=header, listings_report=''.join(parts))] = links
+            parts = []
+            parts_len = 0
+            links = []
 
         links.append(listing.link)
-        listings_report += report
+        parts.append(report)
+        parts_len += len(report)
 
-    if len(report_by_listing) > 0:
-        links_by_message_body[BODY_TEMPLATE.format(header=header, listings_report=listings_report)] = links
+    links_by_message_body[BODY_TEMPLATE.format(header=header, listings_report=''.join(parts))] = links
 
     return links_by_message_body
 
 
-def get_time():
+@functools.lru_cache(maxsize=1)
+def _get_time(minute_key):
     return datetime.datetime.now().strftime("%H:%M")
 
 
+def get_time():
+    # the formatted value only changes once a minute, so key the cache on
+    # the current minute and skip the strftime call otherwise
+    return _get_time(int(time.time() // 60))
+
+
+def daemonize(logfile):
+    """Detach from the controlling terminal with a classic double fork."""
+    if os.fork():
+        # original parent returns to the shell immediately
+        os._exit(0)
+    os.setsid()
+    pid = os.fork()
+    if pid:
+        print("Sending notifier to background with pid %d" % pid)
+        print("  use 'kill %d' to kill the process" % pid)
+        os._exit(0)
+    # Redirect stdio away from the (now detached) terminal. The working
+    # directory is intentionally kept so relative --save/--load paths work.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, sys.stdin.fileno())
+    if logfile:
+        target = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    else:
+        target = devnull
+    os.dup2(target, sys.stdout.fileno())
+    os.dup2(target, sys.stderr.fileno())
+
+
 def main(args):
+    # Imported here rather than at module top so --help and argument
+    # errors don't pay for aiohttp/lxml/smtplib start-up
+    from ksl import KSL
+    from util.email import EmailSession
+
     # Set up logging
     logfile = args.pop('logfile')
     if logfile:
@@ -155,9 +334,18 @@ def main(args):
     minutes = args.pop('time')
     loop_delay = minutes * 60
 
-    # Dictionary to store results of queries
+    # Dictionary to store results of queries; sets give O(1) membership
+    # checks while the JSON file keeps its list-of-links format
     load_file = args.pop("load")
-    seen = io.load_dict(load_file) if load_file else {}
+    if load_file:
+        # files from before the digest change hold full URL strings;
+        # hash them on the way in so membership checks stay uniform
+        seen = {query: {link if isinstance(link, bytes)
+                        else _link_hash(link)
+                        for link in links}
+                for query, links in io.load_seen(load_file).items()}
+    else:
+        seen = {}
 
     sender = args.pop('email', None)
     smtpserver = args.pop('smtpserver', None)
@@ -169,6 +357,10 @@ def main(args):
 
     EmailSession.test_email_login(sender, passwd, smtpserver)
 
+    # One SMTP session for the daemon's lifetime; it connects lazily on
+    # first send (after the fork below) and reconnects if dropped
+    email_session = EmailSession(sender, passwd, smtpserver)
+
     receiver = args.pop('receiver', None)
     if not receiver:
         receiver = sender
@@ -180,30 +372,55 @@ def main(args):
     # Fork to background
     foreground = args.pop('foreground')
     if not foreground:
-        pid = os.fork()
-        if pid:
-            print("Sending notifier to background with pid %d" % pid)
-            print("  use 'kill %d' to kill the process" % pid)
-            sys.exit()
+        daemonize(logfile)
 
     save_file = args.pop("save")
 
+    # Offload SMTP sends to a worker thread so fetching and parsing the
+    # next queries isn't serialized behind mail server round-trips.
+    # Started after the fork above; threads don't survive os.fork().
+    outbox = queue.Queue()
+    threading.Thread(target=email_worker, args=(email_session, outbox),
+                     daemon=True).start()
+
     # find our results
     queries = args.pop('query')
     exception_thresh = int(args.pop('emailexceptions')) * 10
     exception_count = 0
+    consecutive_failures = 0
     today = None
 
+    # one KSL instance for the daemon's lifetime keeps its HTTP session
+    # (and conditional-GET validators) warm between polls
+    ksl = KSL()
+
+    # kill -USR1 forces an immediate poll, SIGTERM a prompt clean exit
+    signal.signal(signal.SIGUSR1, _handle_wake)
+    signal.signal(signal.SIGTERM, _handle_shutdown)
+
     while True:
+        new_links = {}
         try:
             logging.debug("Checking KSL")
-            seen = check_ksl(args, queries, seen, receiver, sender, passwd, smtpserver)
-            # log seen list daily for debug
+            seen = check_ksl(ksl, args, queries, seen, receiver, sender,
+                             outbox, new_links)
+            # log seen list size daily for debug; the full dump grew
+            # unbounded with the dict and stringified it even at INFO
             if today != datetime.date.today():
-                logging.debug("seen list: %s" % (seen))
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("seen list size: %d queries, %d total links",
+                                  len(seen), sum(map(len, seen.values())))
                 today = datetime.date.today()
-            if exception_count > 0:
+            # send failures happen on the worker thread; fold messages it
+            # dropped into the same ladder that fetch failures feed
+            dropped = _drain_send_failures()
+            if dropped:
+                logging.error("%d emails dropped after repeated send "
+                              "failures", dropped)
+                exception_count += 10 * dropped
+            elif exception_count > 0:
                 exception_count -= 10
+            consecutive_failures = 0
         # While looping in daemon mode, try to keep executing
         # This will catch bad server connections, etc.
         except KeyboardInterrupt:
@@ -212,22 +429,23 @@ def main(args):
             # This is frequent-ish, so don't report, but still keep track
             logging.debug("Socket timeout")
             exception_count += 10
+            consecutive_failures += 1
         except Exception as e:
             logging.exception("Exception found in main loop")
             exception_count += 10
+            consecutive_failures += 1
             try:
                 exc_txt = str(e)
                 if exception_count > exception_thresh:
-                    message = MESSAGE_TEMPLATE.format(subject="KSL Notifier Failure",
-                                                      receiver=exception_receiver, sender=sender,
-                                                      body="Exception in script detected.\n" \
-                                                           "Exception count %d\n" \
-                                                           "The script will die after the count reaches 10\n" \
-                                                           "%s" % (exception_count / 10, exc_txt))
-
-                    with EmailSession(sender, passwd, smtpserver) as email_session:
-                        logging.info("Sending exception message to {receiver}".format(receiver=exception_receiver))
-                        email_session.sendmail(sender, exception_receiver, message)
+                    message = build_message("KSL Notifier Failure",
+                                            sender, exception_receiver,
+                                            "Exception in script detected.\n"
+                                            "Exception count %d\n"
+                                            "The script will die after the count reaches 10\n"
+                                            "%s" % (exception_count / 10, exc_txt))
+
+                    logging.info("Queueing exception message to %s", exception_receiver)
+                    outbox.put(message)
             except e:
                 logging.debug(
                     "There was an issue sending the exception message to {sender}. {e}".format(sender=sender, e=e))
@@ -238,11 +456,37 @@ def main(args):
                 raise
         finally:
             if save_file:
-                io.save_dict(save_file, seen)
-            logging.debug("Exception count is {count}".format(count=exception_count / 10))
-
-        logging.debug("Sleeping for {minutes} minutes".format(minutes=minutes))
-        time.sleep(loop_delay)
+                # journal just this poll's additions; a full snapshot is
+                # only rewritten when the journal outgrows it
+                for query, links in new_links.items():
+                    if links:
+                        io.append_seen(save_file, query, links)
+                if io.needs_compaction(save_file):
+                    io.compact_seen(save_file, {query: sorted(links)
+                                                for query, links in seen.items()})
+            logging.debug("Exception count is %d", exception_count / 10)
+
+        if not _shutdown.is_set():
+            # back off exponentially while polls keep failing so an
+            # outage isn't hammered at full cadence; one success resets.
+            # The cap only applies to the backoff, never shortening a
+            # configured cadence longer than an hour
+            if consecutive_failures == 0:
+                delay = loop_delay
+            else:
+                delay = min(loop_delay * 2 ** consecutive_failures,
+                            max(3600, loop_delay))
+            logging.debug("Sleeping for %d seconds", delay)
+            if _wake.wait(delay):
+                _wake.clear()
+        if _shutdown.is_set():
+            logging.info("Termination requested, shutting down")
+            break
+
+    # the finally block above already saved; drain the outbox and close
+    outbox.join()
+    ksl.close()
+    email_session.close()
 
 
 if __name__ == '__main__':
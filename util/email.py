@@ -2,20 +2,34 @@ import logging
 import smtplib
 import sys
 
+# Known providers' SMTP servers, keyed by email hostname
+SMTP_SERVERS = {
+    'gmail.com': 'smtp.gmail.com:587',
+    'yahoo.com': 'smtp.mail.yahoo.com:587',
+    'outlook.com': 'smtp-mail.outlook.com:587',
+    'hotmail.com': 'smtp-mail.outlook.com:587',
+    'msn.com': 'smtp-mail.outlook.com:587',
+    'comcast.net': 'smtp.comcast.net:587',
+}
+
 
 class EmailSession(object):
     def __init__(self, sender, password, smtpserver, timeout=120):
         self.sender = sender
         self.password = password
-        self.smtpserver = smtpserver
+        # parse host:port once; connect() may run many times over the
+        # daemon's life as dropped connections are re-established
+        smtp_addr, smtp_port = smtpserver.split(":")
+        self.smtp_addr = smtp_addr
+        self.smtp_port = int(smtp_port)
         self.timeout = timeout
         self.smtp = None
 
-    def __enter__(self):
+    def connect(self):
         logging.debug("Opening email session...")
-        smtp_addr, smtp_port = self.smtpserver.split(":")
         logging.debug("Getting smtp...")
-        self.smtp = smtplib.SMTP(smtp_addr, int(smtp_port), timeout=self.timeout)
+        self.smtp = smtplib.SMTP(self.smtp_addr, self.smtp_port,
+                                 timeout=self.timeout)
         logging.debug("Sending ehlo command...")
         self.smtp.ehlo()
         logging.debug("Starting tls...")
@@ -23,14 +37,41 @@ class EmailSession(object):
         logging.debug("Logging in to email...")
         self.smtp.login(self.sender, self.password)
         logging.debug("Email session started.")
-        return self.smtp
 
-    def __exit__(self, exc_type, exc_value, tb):
-        if exc_value and exc_value and tb:
-            logging.warning("Exception occurred. Type: {type} | Value: {value} | Traceback: {tb}"
-                        .format(type=exc_type, value=exc_value, tb=tb))
-        self.smtp.quit()
-        logging.debug("Email session closed.")
+    def ensure_alive(self):
+        # Probe the idle connection with a cheap NOOP and reconnect if the
+        # server hung up while the daemon slept between polls.
+        if self.smtp is None:
+            self.connect()
+            return
+        try:
+            self.smtp.noop()
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPException):
+            logging.debug("SMTP keepalive failed, reconnecting...")
+            self.connect()
+
+    def send_message(self, message):
+        # The connection persists between calls; TLS handshake and login
+        # only happen on first use or after the server hangs up on us.
+        # send_message takes an email.message.EmailMessage and derives the
+        # envelope from its From/To headers.
+        if self.smtp is None:
+            self.connect()
+        try:
+            self.smtp.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            logging.debug("SMTP connection dropped, reconnecting...")
+            self.connect()
+            self.smtp.send_message(message)
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            self.smtp = None
+            logging.debug("Email session closed.")
 
     @staticmethod
     def test_email_login(email, password, smtpserver):
@@ -52,15 +93,8 @@ class EmailSession(object):
     def get_smtp(email):
         # Maybe there's a service or library that does this?
         hostname = email.split("@", 1)[-1]
-        if hostname == 'gmail.com':
-            smtp_server = 'smtp.gmail.com:587'
-        elif hostname == 'yahoo.com':
-            smtp_server = 'smtp.mail.yahoo.com:587'
-        elif hostname == 'outlook.com' or hostname == 'hotmail.com' or hostname == 'msn.com':
-            smtp_server = 'smtp-mail.outlook.com:587'
-        elif hostname == 'comcast.net':
-            smtp_server = 'smtp.comcast.net:587'
-        else:
+        smtp_server = SMTP_SERVERS.get(hostname)
+        if smtp_server is None:
             logging.error("Unknown email server, please provide --smtpserver")
             print("Unknown email server, please provide --smtpserver",
                   file=sys.stderr)
@@ -1,14 +1,106 @@
 import logging
 import json
+import os
+import pickle
+import pickletools
 
 
 def save_dict(file, d):
-    logging.info("Saving file {file}".format(file=file))
-    with open(file, 'w') as f:
-        json.dump(d, f, indent=2)
+    # binary pickle: the opcode stream is written and read in C, unlike
+    # indented JSON which escapes the dict one character at a time.
+    # pickletools.optimize drops unused MEMOIZE/PUT opcodes, trading a
+    # slightly slower save (rare) for a faster load (startup, user waits)
+    # Write-then-rename so a crash mid-save can't leave a truncated
+    # snapshot behind; a corrupt seen store would re-email everything
+    logging.info("Saving file %s", file)
+    data = pickletools.optimize(
+        pickle.dumps(d, protocol=pickle.HIGHEST_PROTOCOL))
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, file)
 
 
 def load_dict(file):
-    logging.info("Loading file {file}".format(file=file))
-    with open(file, 'r') as f:
-        return json.load(f)
\ No newline at end of file
+    logging.info("Loading file %s", file)
+    with open(file, 'rb') as f:
+        try:
+            return pickle.load(f)
+        except pickle.UnpicklingError:
+            # snapshot predates the pickle format; read it as JSON once
+            # and the next save rewrites it as pickle
+            f.seek(0)
+            return json.loads(f.read().decode())
+
+
+def append_seen(file, query, links):
+    # One pickled record per poll; each poll only writes its own new
+    # links instead of rewriting the whole accumulated dict
+    logging.debug("Journaling %d links for %s", len(links), query)
+    with open(file + '.log', 'ab') as f:
+        pickle.dump((query, list(links)), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _replay_journal(f, seen):
+    # A crash mid-append can leave a truncated final record; treat any
+    # parse failure as end-of-journal. The unjournaled links just get
+    # re-reported next poll, which beats refusing to start.
+    try:
+        while True:
+            query, links = pickle.load(f)
+            seen.setdefault(query, []).extend(links)
+    except (EOFError, pickle.UnpicklingError):
+        pass
+
+
+def _replay_json_journal(f, seen):
+    # journals from before the pickle format: one JSON object per line,
+    # with the same torn-tail tolerance as the pickle replay
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        seen.setdefault(record['q'], []).extend(record['links'])
+
+
+def load_seen(file):
+    seen = load_dict(file)
+    try:
+        with open(file + '.log', 'rb') as f:
+            # pickle streams open with the PROTO opcode; anything else
+            # is a legacy JSON-lines journal
+            if f.read(1) == b'\x80':
+                f.seek(0)
+                _replay_journal(f, seen)
+            else:
+                f.seek(0)
+                _replay_json_journal(f, seen)
+    except FileNotFoundError:
+        pass
+    return seen
+
+
+def needs_compaction(file):
+    # compact once the journal outgrows the snapshot (or the snapshot
+    # doesn't exist yet)
+    try:
+        log_size = os.path.getsize(file + '.log')
+    except OSError:
+        return False
+    try:
+        return log_size > os.path.getsize(file)
+    except OSError:
+        return True
+
+
+def compact_seen(file, d):
+    logging.info("Compacting journal into %s", file)
+    save_dict(file, d)
+    try:
+        os.remove(file + '.log')
+    except FileNotFoundError:
+        pass
\ No newline at end of file